@@ -1,15 +1,17 @@
-from flask import Flask, request, jsonify, render_template, g
+from flask import Flask, request, jsonify, render_template, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from dotenv import load_dotenv
-from structured_logging import setup_structured_logging, StructuredLogger
+from structured_logging import setup_structured_logging, default_logger, get_request_id
 import time
 import os
+import orjson
 import pymysql
 import logging
-import uuid
-from sqlalchemy import text
+import random
+import threading
+from sqlalchemy import delete, insert, lambda_stmt, select, text, update
 
 # Load environment variables from .env file
 load_dotenv()
@@ -47,24 +49,91 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
     'pool_recycle': 300,
 }
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Connection pool sizing: size the pool to the worker's concurrency
+    # (pool = threads serving requests + background executors + 1) so requests
+    # never queue waiting for a connection. pool_timeout fails fast instead of
+    # piling up threads when the pool is exhausted. SQLite is left alone, since
+    # in-memory databases use StaticPool, which rejects these options.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': 2,
+        'pool_use_lifo': True,
+    })
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('mysql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'connect_timeout': 2}
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# Pagination limits for GET /api/todos
+TODOS_PAGE_SIZE = 50
+TODOS_MAX_PAGE_SIZE = 500
+
 # Prometheus metrics
 REQUEST_COUNT = Counter('todoapp_requests_total', 'Total requests', ['method', 'endpoint'])
 REQUEST_LATENCY = Histogram('todoapp_request_duration_seconds', 'Request latency')
 
+# Labelled REQUEST_COUNT children keyed by (method, endpoint), so the hot path
+# skips the registry's label lookup and lock
+_request_count_children = {}
+
+class MetricsMiddleware:
+    """WSGI middleware recording request count and latency outside Flask's callback chain"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start_ns = environ['todoapp.start_ns'] = time.perf_counter_ns()
+
+        def metered_start_response(status, headers, exc_info=None):
+            # Flask registers its request object in the environ, which gives us the endpoint
+            flask_request = environ.get('werkzeug.request')
+            key = (environ['REQUEST_METHOD'], flask_request.endpoint if flask_request is not None else None)
+            counter = _request_count_children.get(key)
+            if counter is None:
+                counter = _request_count_children[key] = REQUEST_COUNT.labels(method=key[0], endpoint=key[1])
+            counter.inc()
+            REQUEST_LATENCY.observe((time.perf_counter_ns() - start_ns) * 1e-9)
+            return start_response(status, headers, exc_info)
+
+        return self.wsgi_app(environ, metered_start_response)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+# Rendered /metrics payload: [rendered_at (monotonic), body]
+METRICS_CACHE_SECONDS = 1.0
+_metrics_cache = [0.0, b'']
+
+# Last /health database probe: [probed_at (monotonic), status]
+DB_PROBE_SECONDS = 30
+_db_probe = [0.0, None]
+
 # Configure structured logging for Kubernetes/Splunk
 setup_structured_logging()
-structured_logger = StructuredLogger('todoapp')
+structured_logger = default_logger
+
+# Pending /simulate/timeout completions; bounded so load tests can't pile them up
+SIMULATE_MAX_PENDING = 32
+_simulate_slots = threading.BoundedSemaphore(SIMULATE_MAX_PENDING)
+
+# Fraction of /simulate/* hits that emit their business event (default every hit;
+# lower it for load tests)
+SIMULATE_LOG_SAMPLE = float(os.environ.get('SIMULATE_LOG_SAMPLE', '1.0'))
+
+# High-frequency, low-value endpoints that skip per-request logging
+_SILENT_ENDPOINTS = frozenset({'metrics', 'health_check', 'static'})
 
 class Todo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(200))
     completed = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # default= keeps tables created before server_default was added (which have
+    # no DB-side DEFAULT) populated; server_default covers new tables
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp(), server_default=db.func.current_timestamp())
 
     def to_dict(self):
         return {
@@ -75,17 +144,17 @@ class Todo(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
-@app.before_request
-def before_request():
-    request.start_time = time.time()
-    g.request_id = str(uuid.uuid4())
-
+# lambda_stmt caches the statement keyed on the lambda's code, so the select()
+# expression tree is built once per process instead of on every request
+_LATEST_TODO = lambda_stmt(lambda: select(Todo).order_by(Todo.id.desc()).limit(1))
 
 @app.after_request
 def after_request(response):
-    REQUEST_COUNT.labels(method=request.method, endpoint=request.endpoint).inc()
-    request_latency = time.time() - request.start_time
-    REQUEST_LATENCY.observe(request_latency)
+    # Scrapes, probes and static assets are counted by MetricsMiddleware but not logged
+    if request.endpoint in _SILENT_ENDPOINTS:
+        return response
+
+    request_latency = (time.perf_counter_ns() - request.environ['todoapp.start_ns']) * 1e-9
 
     try:
         structured_logger.log_request(
@@ -106,8 +175,32 @@ def index():
 
 @app.route('/api/todos', methods=['GET'], endpoint='get_todos_api')
 def get_todos():
-    todos = Todo.query.all()
-    return jsonify([todo.to_dict() for todo in todos])
+    # Keyset pagination: ?limit=N&cursor=<last id from previous page>
+    limit = max(1, min(request.args.get('limit', TODOS_PAGE_SIZE, type=int), TODOS_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor', type=int)
+
+    # Select plain columns rather than Todo objects to skip ORM hydration
+    q = lambda_stmt(lambda: select(Todo.id, Todo.title, Todo.description, Todo.completed, Todo.created_at).order_by(Todo.id))
+    if cursor:
+        q += lambda s: s.where(Todo.id > cursor)
+    q += lambda s: s.limit(limit)
+    rows = db.session.execute(q).all()
+
+    body = orjson.dumps([
+        {
+            'id': row.id,
+            'title': row.title,
+            'description': row.description,
+            'completed': row.completed,
+            'created_at': row.created_at
+        }
+        for row in rows
+    ])
+
+    response = Response(body, mimetype='application/json')
+    if len(rows) == limit:
+        response.headers['X-Next-Cursor'] = str(rows[-1].id)
+    return response
 
 @app.route('/api/todos', methods=['POST'])
 def create_todo():
@@ -120,25 +213,40 @@ def create_todo():
         }, log_level='WARN')
         return jsonify({'error': 'Title is required'}), 400
 
-    todo = Todo(
-        title=data['title'],
-        description=data.get('description', ''),
-        completed=data.get('completed', False)
-    )
+    values = {
+        'title': data['title'],
+        'description': data.get('description', ''),
+        'completed': data.get('completed', False)
+    }
 
     try:
-        db.session.add(todo)
+        # Core INSERT skips the ORM unit of work for a single-row write
+        stmt = insert(Todo).values(**values)
+        columns = (Todo.id, Todo.title, Todo.description, Todo.completed, Todo.created_at)
+        if db.engine.dialect.insert_returning:
+            row = db.session.execute(stmt.returning(*columns)).one()
+        else:
+            # MySQL has no RETURNING, so read the stored row back by its new id
+            todo_id = db.session.execute(stmt).inserted_primary_key[0]
+            row = db.session.execute(select(*columns).where(Todo.id == todo_id)).one()
         db.session.commit()
 
         # Log successful todo creation
         structured_logger.log_business_event("todo_created", {
-            "todo_id": todo.id,
-            "title": todo.title,
-            "completed": todo.completed
+            "todo_id": row.id,
+            "title": row.title,
+            "completed": row.completed
         }, log_level='INFO')
         structured_logger.log_database_operation("INSERT", "todos", True, log_level='INFO')
 
-        return jsonify(todo.to_dict()), 201
+        # Built from the stored row so column types match what GET returns
+        return jsonify({
+            'id': row.id,
+            'title': row.title,
+            'description': row.description,
+            'completed': row.completed,
+            'created_at': row.created_at.isoformat() if row.created_at else None
+        }), 201
 
     except Exception as e:
         db.session.rollback()
@@ -148,38 +256,45 @@ def create_todo():
 
 @app.route('/api/todos/<int:todo_id>', methods=['PUT'])
 def update_todo(todo_id):
-    todo = Todo.query.get_or_404(todo_id)
     data = request.get_json()
 
     if not data:
+        # A missing todo still takes precedence over a missing body
+        if db.session.get(Todo, todo_id) is None:
+            return jsonify({'error': 'Todo not found'}), 404
         return jsonify({'error': 'No data provided'}), 400
 
-    old_values = {
-        'title': todo.title,
-        'description': todo.description,
-        'completed': todo.completed
-    }
-
-    todo.title = data.get('title', todo.title)
-    todo.description = data.get('description', todo.description)
-    todo.completed = data.get('completed', todo.completed)
+    changes = {field: data[field] for field in ('title', 'description', 'completed') if field in data}
 
     try:
+        if not changes:
+            todo = db.session.get(Todo, todo_id)
+        elif db.engine.dialect.update_returning:
+            # UPDATE ... RETURNING hands back the updated row in the same round trip
+            todo = db.session.scalars(
+                update(Todo).where(Todo.id == todo_id).values(**changes).returning(Todo)
+            ).first()
+        elif db.session.execute(update(Todo).where(Todo.id == todo_id).values(**changes)).rowcount:
+            # MySQL has no RETURNING, so only re-read when a row matched
+            todo = db.session.get(Todo, todo_id)
+        else:
+            todo = None
+
+        if todo is None:
+            db.session.rollback()
+            return jsonify({'error': 'Todo not found'}), 404
+
+        todo_data = todo.to_dict()
         db.session.commit()
 
         # Log successful update
         structured_logger.log_business_event("todo_updated", {
-            "todo_id": todo.id,
-            "old_values": old_values,
-            "new_values": {
-                'title': todo.title,
-                'description': todo.description,
-                'completed': todo.completed
-            }
+            "todo_id": todo_id,
+            "new_values": changes
         }, log_level='INFO')
         structured_logger.log_database_operation("UPDATE", "todos", True, log_level='INFO')
 
-        return jsonify(todo.to_dict())
+        return jsonify(todo_data)
 
     except Exception as e:
         db.session.rollback()
@@ -189,21 +304,25 @@ def update_todo(todo_id):
 
 @app.route('/api/todos/<int:todo_id>', methods=['DELETE'])
 def delete_todo(todo_id):
-    todo = Todo.query.get_or_404(todo_id)
-    todo_data = {
-        'id': todo.id,
-        'title': todo.title,
-        'completed': todo.completed
-    }
-
     try:
-        db.session.delete(todo)
+        # Single DELETE; RETURNING (or rowcount on MySQL) tells us whether the todo existed
+        stmt = delete(Todo).where(Todo.id == todo_id)
+        if db.engine.dialect.delete_returning:
+            row = db.session.execute(stmt.returning(Todo.title, Todo.completed)).first()
+            deleted_todo = {'id': todo_id, 'title': row.title, 'completed': row.completed} if row else None
+        else:
+            deleted_todo = {'id': todo_id} if db.session.execute(stmt).rowcount else None
+
+        if deleted_todo is None:
+            db.session.rollback()
+            return jsonify({'error': 'Todo not found'}), 404
+
         db.session.commit()
 
         # Log successful deletion
         structured_logger.log_business_event("todo_deleted", {
             "todo_id": todo_id,
-            "deleted_todo": todo_data
+            "deleted_todo": deleted_todo
         }, log_level='INFO')
         structured_logger.log_database_operation("DELETE", "todos", True, log_level='INFO')
 
@@ -217,17 +336,27 @@ def delete_todo(todo_id):
 
 @app.route('/metrics')
 def metrics():
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    # Scrapes are seconds apart, so reuse the rendered registry for a short TTL
+    now = time.monotonic()
+    if now - _metrics_cache[0] > METRICS_CACHE_SECONDS:
+        _metrics_cache[:] = [now, generate_latest()]
+    return _metrics_cache[1], 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
-    try:
-        # Test database connection
-        db.session.execute(text('SELECT 1'))
-        db_status = "healthy"
-    except Exception as e:
-        db_status = f"unhealthy: {str(e)}"
+    # Probes are frequent, so only hit the database every DB_PROBE_SECONDS
+    now = time.monotonic()
+    if _db_probe[1] is None or now - _db_probe[0] > DB_PROBE_SECONDS:
+        try:
+            # Test database connection without opening a transaction
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('SELECT 1'))
+            db_probe_status = "healthy"
+        except Exception as e:
+            db_probe_status = f"unhealthy: {str(e)}"
+        _db_probe[:] = [now, db_probe_status]
+    db_status = _db_probe[1]
 
     health_data = {
         'status': 'healthy' if db_status == 'healthy' else 'unhealthy',
@@ -248,58 +377,78 @@ def health_check():
 @app.route('/simulate/404')
 def simulate_404():
     """Simulate a 404 error for testing"""
-    structured_logger.log_business_event("simulated_error", {
-        "error_type": "404",
-        "endpoint": "/simulate/404",
-        "message": "Simulated 404 error for testing"
-    }, log_level='WARN')
+    if random.random() < SIMULATE_LOG_SAMPLE:
+        structured_logger.log_business_event("simulated_error", {
+            "error_type": "404",
+            "endpoint": "/simulate/404",
+            "message": "Simulated 404 error for testing"
+        }, log_level='WARN')
 
     return jsonify({'error': 'Resource not found', 'simulated': True}), 404
 
 @app.route('/simulate/500')
 def simulate_500():
     """Simulate a 500 error for testing"""
-    structured_logger.log_business_event("simulated_error", {
-        "error_type": "500",
-        "endpoint": "/simulate/500",
-        "message": "Simulated 500 error for testing"
-    }, log_level='ERROR')
+    if random.random() < SIMULATE_LOG_SAMPLE:
+        structured_logger.log_business_event("simulated_error", {
+            "error_type": "500",
+            "endpoint": "/simulate/500",
+            "message": "Simulated 500 error for testing"
+        }, log_level='ERROR')
 
     return jsonify({'error': 'Internal server error', 'simulated': True}), 500
 
 @app.route('/simulate/timeout')
 def simulate_timeout():
     """Simulate a slow response for testing"""
-    import time
-    structured_logger.log_business_event("simulated_slow_response", {
-        "endpoint": "/simulate/timeout",
-        "delay_seconds": 5,
-        "message": "Simulated slow response for testing"
-    }, log_level='WARN')
+    if not _simulate_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many pending slow responses', 'simulated': True}), 503
 
-    time.sleep(5)  # 5 second delay
-    return jsonify({'message': 'Slow response completed', 'delay': '5 seconds', 'simulated': True}), 200
+    deferred_id = get_request_id()
+
+    # The 202 goes out immediately; a daemon timer thread (at most
+    # SIMULATE_MAX_PENDING of them) waits out the delay and then only logs the
+    # completion event. Pending timers are dropped rather than waited on at shutdown
+    timer = threading.Timer(5, _simulated_slow_work, args=(deferred_id, 5))
+    timer.daemon = True
+    timer.start()
+    return jsonify({'message': 'Slow response accepted', 'deferred_id': deferred_id, 'delay': '5 seconds', 'simulated': True}), 202
+
+def _simulated_slow_work(deferred_id, delay):
+    """Completion half of /simulate/timeout, run by its timer after the delay"""
+    try:
+        if random.random() < SIMULATE_LOG_SAMPLE:
+            structured_logger.log_business_event("simulated_slow_response", {
+                "endpoint": "/simulate/timeout",
+                "delay_seconds": delay,
+                "deferred_id": deferred_id,
+                "message": "Simulated slow response for testing"
+            }, log_level='WARN')
+    finally:
+        _simulate_slots.release()
 
 @app.route('/simulate/database-error')
 def simulate_database_error():
     """Simulate a database error for testing"""
-    structured_logger.log_business_event("simulated_error", {
-        "error_type": "database",
-        "endpoint": "/simulate/database-error",
-        "message": "Simulated database error for testing"
-    }, log_level='CRITICAL')
-    structured_logger.log_database_operation("SELECT", "invalid_table", False, log_level='CRITICAL')
+    if random.random() < SIMULATE_LOG_SAMPLE:
+        structured_logger.log_business_event("simulated_error", {
+            "error_type": "database",
+            "endpoint": "/simulate/database-error",
+            "message": "Simulated database error for testing"
+        }, log_level='CRITICAL')
+        structured_logger.log_database_operation("SELECT", "invalid_table", False, log_level='CRITICAL')
 
     return jsonify({'error': 'Database connection failed', 'simulated': True}), 503
 
 @app.route('/simulate/auth-error')
 def simulate_auth_error():
     """Simulate an authentication error for testing"""
-    structured_logger.log_business_event("simulated_error", {
-        "error_type": "401",
-        "endpoint": "/simulate/auth-error",
-        "message": "Simulated authentication error for testing"
-    }, log_level='WARN')
+    if random.random() < SIMULATE_LOG_SAMPLE:
+        structured_logger.log_business_event("simulated_error", {
+            "error_type": "401",
+            "endpoint": "/simulate/auth-error",
+            "message": "Simulated authentication error for testing"
+        }, log_level='WARN')
 
     return jsonify({'error': 'Authentication required', 'simulated': True}), 401
 
@@ -313,7 +462,7 @@ def simulate_add_todo_error():
 @app.route('/simulate/update-todo-error', methods=['PUT'])
 def simulate_update_todo_error():
     """Simulate a failed todo update"""
-    todo = Todo.query.order_by(Todo.id.desc()).first()
+    todo = db.session.scalars(_LATEST_TODO).first()
     if todo:
         structured_logger.log_error("database_error", "Simulated database error on update", context={"operation": "update_todo", "todo_id": todo.id}, log_level='CRITICAL')
         structured_logger.log_database_operation("UPDATE", "todos", False, log_level='CRITICAL')
@@ -324,7 +473,7 @@ def simulate_update_todo_error():
 @app.route('/simulate/delete-todo-error', methods=['DELETE'])
 def simulate_delete_todo_error():
     """Simulate a failed todo deletion"""
-    todo = Todo.query.order_by(Todo.id.desc()).first()
+    todo = db.session.scalars(_LATEST_TODO).first()
     if todo:
         structured_logger.log_error("database_error", "Simulated database error on delete", context={"operation": "delete_todo", "todo_id": todo.id}, log_level='CRITICAL')
         structured_logger.log_database_operation("DELETE", "todos", False, log_level='CRITICAL')
@@ -1,47 +1,229 @@
+import atexit
+import itertools
 import json
 import logging
+import os
+import queue
+import secrets
+import sys
+import threading
 import time
-from datetime import datetime
-from flask import request, g
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from flask import request, g, has_request_context
+
+# Level names accepted by StructuredLogger, in both cases so callers skip .upper()
+_LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARN': logging.WARNING,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+_LEVELS.update({name.lower(): level for name, level in _LEVELS.items()})
+
+# Request ids are "<node>-<pid>-<seq>": cheaper than uuid4 and still unique per worker
+_NODE = secrets.token_hex(4)
+_req_seq = itertools.count(1)
+
+def get_request_id():
+    """Return the current request's id, generating it on first access"""
+    request_id = g.get('request_id')
+    if request_id is None:
+        request_id = g.request_id = f"{_NODE}-{os.getpid()}-{next(_req_seq)}"
+    return request_id
+
+# Last rendered timestamp: [epoch milliseconds, ISO 8601 string]. Records
+# logged within the same millisecond share one string.
+_ts_cache = [-1, '']
+
+def _format_timestamp(created):
+    """Render a record's creation time as ISO 8601 UTC with millisecond precision"""
+    created_ms = int(created * 1000)
+    if created_ms != _ts_cache[0]:
+        seconds, millis = divmod(created_ms, 1000)
+        _ts_cache[:] = [created_ms, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f'.{millis:03d}Z']
+    return _ts_cache[1]
+
+# Per-thread scratch dict for JSONFormatter.format
+_tls = threading.local()
 
 class JSONFormatter(logging.Formatter):
     """Custom JSON formatter for structured logging"""
 
-    def format(self, record):
-        log_entry = {
-            'timestamp': datetime.utcnow().isoformat() + 'Z',
-            'level': record.levelname,
-            'logger': record.name,
-            'message': record.getMessage(),
-            'app': 'todoapp',
-            'service': 'todo-api'
-        }
+    # Fields identical on every record, copied in rather than rebuilt per record
+    _STATIC = {'app': 'todoapp', 'service': 'todo-api'}
 
-        # Add request context if available
-        try:
-            if request:
-                log_entry['http_method'] = request.method
-                log_entry['url'] = request.path
-                log_entry['remote_addr'] = request.remote_addr
-                log_entry['user_agent'] = request.headers.get('User-Agent', '')
-                log_entry['request_id'] = getattr(g, 'request_id', '')
-        except RuntimeError:
-            # Outside request context
-            pass
+    def format(self, record):
+        # Reuse this thread's entry dict; orjson.dumps keeps no reference to it
+        log_entry = getattr(_tls, 'log_entry', None)
+        if log_entry is None:
+            log_entry = _tls.log_entry = {}
+        else:
+            log_entry.clear()
+        log_entry.update(JSONFormatter._STATIC)
+        # Taken from the record, not format time (formatting runs on the listener thread)
+        log_entry['timestamp'] = _format_timestamp(record.created)
+        log_entry['level'] = record.levelname
+        log_entry['logger'] = record.name
+        # getMessage() is only needed to interpolate args or stringify a non-str msg
+        message = record.msg
+        if record.args or not isinstance(message, str):
+            message = record.getMessage()
+        log_entry['message'] = message
+
+        # Add request context captured when the record was queued
+        request_context = record.__dict__.get('request_context')
+        if request_context:
+            log_entry.update(request_context)
 
         # Add exception info if present
         if record.exc_info:
             log_entry['exception'] = self.formatException(record.exc_info)
 
         # Add extra fields
-        if hasattr(record, 'extra_fields'):
-            log_entry.update(record.extra_fields)
+        extra_fields = record.__dict__.get('extra_fields')
+        if extra_fields:
+            log_entry.update(extra_fields)
+
+        # Returned as bytes; BytesJSONHandler writes them without re-encoding
+        try:
+            return orjson.dumps(log_entry)
+        except TypeError:
+            # orjson rejects some values stdlib json accepts (e.g. integers
+            # beyond 64 bits echoed from a client payload)
+            return json.dumps(log_entry, separators=(',', ':')).encode()
+
+class BytesJSONHandler(logging.StreamHandler):
+    """Stream handler that writes the formatter's bytes to a binary stream"""
+
+    terminator = b'\n'
 
-        return json.dumps(log_entry)
+    def __init__(self, stream=None, autoflush=True):
+        super().__init__(stream if stream is not None else sys.stdout.buffer)
+        self.autoflush = autoflush
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if self.autoflush:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+class TextJSONHandler(logging.StreamHandler):
+    """Fallback for text-only streams, such as a StringIO standing in for stdout"""
+
+    def format(self, record):
+        return super().format(record).decode()
+
+def _stdout_handler():
+    """Return the cheapest JSON handler that still writes to the current sys.stdout"""
+    stdout = sys.stdout
+    if stdout is sys.__stdout__:
+        try:
+            # Own 64 KiB buffer on fd 1 so each record doesn't cost a write() syscall
+            return BytesJSONHandler(open(stdout.fileno(), 'wb', buffering=65536, closefd=False), autoflush=False)
+        except (AttributeError, OSError, ValueError):
+            pass  # No usable file descriptor (e.g. mod_wsgi)
+
+    # sys.stdout is redirected or has no descriptor: write through it instead
+    buffer = getattr(stdout, 'buffer', None)
+    if buffer is not None:
+        return BytesJSONHandler(buffer)
+    return TextJSONHandler(stdout)
+
+def _request_context():
+    """Return the current request's log fields, or None outside a request
+
+    The fields are read from the request proxy once and cached on g, so every
+    later record in the same request costs a single lookup.
+    """
+    if not has_request_context():
+        return None
+
+    log_ctx = g.get('_log_ctx')
+    if log_ctx is None:
+        log_ctx = g._log_ctx = {
+            'http_method': request.method,
+            'url': request.path,
+            'remote_addr': request.remote_addr,
+            'user_agent': request.headers.get('User-Agent', ''),
+            'request_id': get_request_id()
+        }
+    return log_ctx
+
+class RequestContextQueueHandler(QueueHandler):
+    """Queue handler that snapshots the request context before enqueueing
+
+    Records are formatted on the listener thread, where Flask's request
+    context is not available.
+    """
+
+    def prepare(self, record):
+        record.request_context = _request_context()
+        return record
+
+def _flush_periodically(handler, stop, interval):
+    """Bound how long buffered log lines wait before reaching stdout"""
+    while not stop.wait(interval):
+        handler.flush()
+
+class _RequestSampler:
+    """Keeps one in `rate` successful request logs and counts the ones dropped"""
+
+    def __init__(self, rate=1):
+        self.rate = rate
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._skipped = 0
+
+    def keep(self):
+        if self.rate <= 1 or next(self._seq) % self.rate == 0:
+            return True
+        with self._lock:
+            self._skipped += 1
+        return False
+
+    def take_skipped(self):
+        """Return and reset the number of request logs dropped so far"""
+        with self._lock:
+            skipped, self._skipped = self._skipped, 0
+        return skipped
+
+_request_sampler = _RequestSampler()
+
+def _report_sampled_requests(stop, interval):
+    """Periodically log how many successful request logs were sampled out"""
+    logger = logging.getLogger('todoapp')
+    while not stop.wait(interval):
+        skipped = _request_sampler.take_skipped()
+        if skipped:
+            logger.info("Sampled out %d successful request logs", skipped, extra={'extra_fields': {
+                'event_type': 'http_request_sampling',
+                'sampled_out': skipped,
+                'sample_rate': _request_sampler.rate
+            }})
+
+def _stop_logging(listener, handler, stop):
+    """Drain queued records and flush the buffer at interpreter exit"""
+    stop.set()
+    listener.stop()
+    handler.flush()
 
 def setup_structured_logging():
     """Configure structured JSON logging for Kubernetes/Splunk"""
 
+    # JSONFormatter never emits process, thread or task names, so don't have
+    # every LogRecord look them up (re-enable these if the fields are added)
+    logging.logProcesses = False
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    logging.logAsyncioTasks = False
+
     # Create JSON formatter
     json_formatter = JSONFormatter()
 
@@ -52,10 +234,35 @@ def setup_structured_logging():
     # Remove default handlers
     root_logger.handlers.clear()
 
-    # Add console handler with JSON formatter
-    console_handler = logging.StreamHandler()
+    # Write JSON lines to stdout; the handler's buffer is flushed every 100ms
+    console_handler = _stdout_handler()
     console_handler.setFormatter(json_formatter)
-    root_logger.addHandler(console_handler)
+
+    # Request threads only enqueue records; a listener thread formats and writes them
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(RequestContextQueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+    listener.start()
+
+    stop_background = threading.Event()
+    threading.Thread(
+        target=_flush_periodically,
+        args=(console_handler, stop_background, 0.1),
+        name='log-flusher',
+        daemon=True
+    ).start()
+    atexit.register(_stop_logging, listener, console_handler, stop_background)
+
+    # Log only 1 in REQUEST_LOG_SAMPLE_RATE successful requests; 4xx/5xx are
+    # always logged, and the dropped count is reported once a minute
+    _request_sampler.rate = int(os.environ.get('REQUEST_LOG_SAMPLE_RATE', '1'))
+    if _request_sampler.rate > 1:
+        threading.Thread(
+            target=_report_sampled_requests,
+            args=(stop_background, 60),
+            name='request-log-sampling',
+            daemon=True
+        ).start()
 
     # Configure specific loggers
     logging.getLogger('werkzeug').setLevel(logging.WARNING)  # Reduce Flask noise
@@ -63,38 +270,37 @@ def setup_structured_logging():
 
     return root_logger
 
+# Shared stand-in for omitted data/context; records are only ever serialized, never mutated
+_EMPTY = {}
+
 class StructuredLogger:
     """Helper class for structured business event logging"""
 
     def __init__(self, logger_name='todoapp'):
         self.logger = logging.getLogger(logger_name)
+        self._enabled = self.logger.isEnabledFor
 
     def log_business_event(self, event_type, data=None, log_level='INFO'):
         """Log business events with structured data"""
-        try:
-            if request:
-                g.request_logged = True
-        except RuntimeError:
-            pass  # Not in a request context
+        level = _LEVELS.get(log_level, logging.INFO)
+        if not self._enabled(level):
+            return
+
+        if has_request_context():
+            g.request_logged = True
 
         log_data = {
             'event_type': 'business_event',
             'business_event': event_type,
-            'data': data or {}
+            'data': data if data is not None else _EMPTY
         }
 
-        # Add to record for JSON formatter
-        record = logging.LogRecord(
-            name=self.logger.name,
-            level=getattr(logging, log_level.upper(), logging.INFO),
-            pathname='',
-            lineno=0,
-            msg=f"Business event: {event_type}",
-            args=(),
-            exc_info=None
+        # makeRecord goes through the record factory without logger.log()'s findCaller()
+        # stack walk; the message is %-formatted lazily on the listener thread
+        record = self.logger.makeRecord(
+            self.logger.name, level, '', 0, "Business event: %s", (event_type,), None,
+            extra={'extra_fields': log_data}
         )
-        record.extra_fields = log_data
-
         self.logger.handle(record)
 
     def log_database_operation(self, operation, table, success, error=None, log_level=None):
@@ -102,6 +308,10 @@ class StructuredLogger:
         if log_level is None:
             log_level = 'INFO' if success else 'ERROR'
 
+        level = _LEVELS.get(log_level, logging.INFO)
+        if not self._enabled(level):
+            return
+
         log_data = {
             'event_type': 'database_operation',
             'operation': operation,
@@ -110,20 +320,11 @@ class StructuredLogger:
             'error': error
         }
 
-        level = getattr(logging, log_level.upper(), logging.INFO)
-        message = f"Database {operation} on {table}: {'SUCCESS' if success else 'FAILED'}"
-
-        record = logging.LogRecord(
-            name=self.logger.name,
-            level=level,
-            pathname='',
-            lineno=0,
-            msg=message,
-            args=(),
-            exc_info=None
+        record = self.logger.makeRecord(
+            self.logger.name, level, '', 0, "Database %s on %s: %s",
+            (operation, table, 'SUCCESS' if success else 'FAILED'), None,
+            extra={'extra_fields': log_data}
         )
-        record.extra_fields = log_data
-
         self.logger.handle(record)
 
     def log_request(self, method, endpoint, status_code, duration, log_level=None):
@@ -131,6 +332,13 @@ class StructuredLogger:
         if log_level is None:
             log_level = 'INFO' if status_code < 400 else 'WARN'
 
+        level = _LEVELS.get(log_level, logging.INFO)
+        if not self._enabled(level):
+            return
+
+        if status_code < 400 and not _request_sampler.keep():
+            return
+
         log_data = {
             'event_type': 'http_request',
             'http_method': method,
@@ -139,46 +347,36 @@ class StructuredLogger:
             'duration_seconds': duration
         }
 
-        level = getattr(logging, log_level.upper(), logging.INFO)
-        message = f"{method} {endpoint} {status_code} ({duration:.3f}s)"
-
-        record = logging.LogRecord(
-            name=self.logger.name,
-            level=level,
-            pathname='',
-            lineno=0,
-            msg=message,
-            args=(),
-            exc_info=None
+        record = self.logger.makeRecord(
+            self.logger.name, level, '', 0, "%s %s %d (%.3fs)",
+            (method, endpoint, status_code, duration), None,
+            extra={'extra_fields': log_data}
         )
-        record.extra_fields = log_data
-
         self.logger.handle(record)
 
     def log_error(self, error_type, error_message, context=None, log_level='ERROR'):
         """Log application errors"""
-        try:
-            if request:
-                g.request_logged = True
-        except RuntimeError:
-            pass  # Not in a request context
-            
+        level = _LEVELS.get(log_level, logging.ERROR)
+        if not self._enabled(level):
+            return
+
+        if has_request_context():
+            g.request_logged = True
+
         log_data = {
             'event_type': 'application_error',
             'error_type': error_type,
             'error_message': error_message,
-            'context': context or {}
+            'context': context if context is not None else _EMPTY
         }
 
-        record = logging.LogRecord(
-            name=self.logger.name,
-            level=getattr(logging, log_level.upper(), logging.ERROR),
-            pathname='',
-            lineno=0,
-            msg=f"Application error: {error_type} - {error_message}",
-            args=(),
-            exc_info=None
+        record = self.logger.makeRecord(
+            self.logger.name, level, '', 0, "Application error: %s - %s",
+            (error_type, error_message), None,
+            extra={'extra_fields': log_data}
         )
-        record.extra_fields = log_data
+        self.logger.handle(record)
 
-        self.logger.handle(record)
\ No newline at end of file
+# Shared instance for the application; import this instead of constructing
+# StructuredLogger per request
+default_logger = StructuredLogger()
\ No newline at end of file